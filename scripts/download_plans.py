@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import logging
 import os
+import shutil
 from os import path
 
+import aiohttp
 import click
-import requests
+import orjson
 
 logging.basicConfig(format="%(levelname)s : %(message)s", level=logging.INFO)
 
@@ -18,6 +21,15 @@ PLANS_FILE = path.join(DIRNAME, "../src/plans.json")
 
 OUTPUT_DIR = path.abspath(path.join(DIRNAME, "../data/raw/plan_html"))
 
+# max number of plans to download at once, so we stay polite to the servers
+MAX_CONCURRENT_DOWNLOADS = 16
+
+HEADERS = {
+    # add user agent to avoid some 403s
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
+}
+
+
 def create_output_dir():
     """
     Make empty output directory
@@ -25,9 +37,75 @@ def create_output_dir():
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
+
 def clear_output_dir():
-    for file_path in os.listdir(OUTPUT_DIR):
-        os.remove(path.join(OUTPUT_DIR, file_path))
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+
+def write_plan_file(filename, plan_record):
+    with open(filename, "wb") as plan_text_file:
+        plan_text_file.write(orjson.dumps(plan_record))
+
+
+async def download_plan(session, semaphore, plan):
+    """
+    Download a single plan as html, and write it to the output directory
+    """
+    filename = path.join(OUTPUT_DIR, f"{plan['id']}.json")
+
+    if os.path.exists(filename):
+        logger.info(f"Plan already downloaded. Skipping {plan['id']}")
+        return
+
+    # if we already have the "full text" of a plan in plans.json for some reason or another
+    if plan.get("full_text"):
+        logger.info(
+            f"Full text available for {plan['id']}. Saving and skipping download"
+        )
+        await asyncio.to_thread(
+            write_plan_file,
+            filename,
+            {"full_text": plan["full_text"], "url": plan["url"], "id": plan["id"]},
+        )
+        return
+
+    async with semaphore:
+        logger.info(f"Downloading {plan['url']}")
+
+        async with session.get(plan["url"]) as resp:
+            if resp.status != 200:
+                logger.warning(
+                    f"Plan {plan['id']} not downloaded. Status code: {resp.status}. Url: {plan['url']}"
+                )
+                return
+
+            html = await resp.text()
+
+    logger.info(f"Writing plan html to {filename}")
+    # file writes are blocking, so keep them off the event loop
+    await asyncio.to_thread(
+        write_plan_file, filename, {"html": html, "url": plan["url"], "id": plan["id"]}
+    )
+
+
+async def download_all_plans(plans):
+    """
+    Download all plans concurrently
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        results = await asyncio.gather(
+            *(download_plan(session, semaphore, plan) for plan in plans),
+            return_exceptions=True,
+        )
+
+    for plan, result in zip(plans, results):
+        if isinstance(result, Exception):
+            logger.warning(
+                f"Plan {plan['id']} not downloaded. Error: {result!r}. Url: {plan['url']}"
+            )
 
 
 @click.command()
@@ -48,54 +126,7 @@ def download_plans(force_redownload=False):
     if force_redownload:
         clear_output_dir()
 
-    # Iterate through plans_dict, download html
-    for plan in plans:
-        filename = path.join(OUTPUT_DIR, f"{plan['id']}.json")
-
-        if os.path.exists(filename):
-            logger.info(f"Plan already downloaded. Skipping {plan['id']}")
-            continue
-
-        # if we already have the "full text" of a plan in plans.json for some reason or another
-        if plan.get("full_text"):
-            logger.info(
-                f"Full text available for {plan['id']}. Saving and skipping download"
-            )
-
-            with open(filename, "w") as plan_text_file:
-                json.dump(
-                    {
-                        "full_text": plan["full_text"],
-                        "url": plan["url"],
-                        "id": plan["id"],
-                    },
-                    plan_text_file,
-                )
-            continue
-
-        logger.info(f"Downloading {plan['url']}")
-
-        resp = requests.get(
-            plan["url"],
-            headers={
-                # add user agent to avoid some 403s
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
-            },
-        )
-
-        if resp.status_code != 200:
-            logger.warning(
-                f"Plan {plan['id']} not downloaded. Status code: {resp.status_code}. Url: {plan['url']}"
-            )
-            continue
-
-        html = resp.text
-
-        logger.info(f"Writing plan html to {filename}")
-        with open(filename, "w") as plan_text_file:
-            json.dump(
-                {"html": html, "url": plan["url"], "id": plan["id"]}, plan_text_file
-            )
+    asyncio.run(download_all_plans(plans))
 
 
 if __name__ == "__main__":
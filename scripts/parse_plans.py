@@ -3,12 +3,16 @@
 import glob
 import json
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 from os import path
 from urllib.parse import urlparse
 
-from bs4 import BeautifulSoup, Comment
+import lxml.html
+import orjson
+from lxml import etree
 from unidecode import unidecode
 
 DIRNAME = path.dirname(path.realpath(__file__))
@@ -23,64 +27,74 @@ logging.basicConfig(format="%(levelname)s : %(message)s", level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+CALCULATOR_PARAGRAPH_RE = re.compile(r"Use this handy calculator.*")
+CALCULATOR_LINK_RE = re.compile(r"calculator")
+AS_PUBLISHED_RE = re.compile(r"As published (on Medium|in Essence).*")
+EXPERT_LETTER_RE = re.compile(r"Read expert letter.*here")
+
+# shared by every plan. comments are dropped while parsing ("<---blah--->"), so
+# they never make it into the tree
+HTML_PARSER = lxml.html.HTMLParser(recover=True, remove_comments=True)
+
 
 def clear_output_dir():
     """
     Make empty output directory
     """
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
-
-    for file_path in os.listdir(OUTPUT_DIR):
-        os.remove(path.join(OUTPUT_DIR, file_path))
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
-def unwrap_and_smooth(soup, tag):
+def unwrap(tree, *tags):
     """
-    Remove html tag, preserving contents as text
+    Remove html tags, preserving contents as text
     """
-    # remove tag
-    for t in soup.findAll(tag):
-        t.unwrap()
-    # smooth together the text that was in those tags with neighboring text
-    soup.smooth()
+    etree.strip_tags(tree, *tags)
 
 
-def decompose_and_smooth(soup, tag, **kwargs):
+def _string(el):
     """
-    Remove html tag including any contents
+    The element's text if it has no child elements, or its only child's string if it
+    has exactly one child and no text of its own. Otherwise None, like bs4's Tag.string
     """
-    # remove tag
-    for t in soup.findAll(tag, **kwargs):
-        t.decompose()
-    # smooth together the text that was in those tags with neighboring text
-    soup.smooth()
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return _string(el[0])
+    return None
 
 
-def decompose_and_smooth_first(soup, tag, **kwargs):
+def _with_text(elements, text):
     """
-    Remove first matching html tag including any contents
+    Filter elements to those whose string matches the compiled regex
     """
-    # remove tag
-    t = soup.find(tag, **kwargs)
-    if t:
-        t.decompose()
-    # smooth together the text that was in those tags with neighboring text
-    soup.smooth()
+    return [el for el in elements if text.search(_string(el) or "")]
 
 
-def remove_html_comments(soup):
+def decompose(tree, xpath, text=None):
     """
-    Remove html comments entirely ("<---blah--->")
+    Remove html elements including any contents
     """
-    comments = soup.findAll(text=lambda text: isinstance(text, Comment))
-    for comment in comments:
-        comment.extract()
+    elements = tree.xpath(xpath)
+    if text:
+        elements = _with_text(elements, text)
+    for el in elements:
+        # drop_tree keeps the text following the element
+        el.drop_tree()
 
-    soup.smooth()
 
+def decompose_first(tree, xpath, text=None):
+    """
+    Remove first matching html element including any contents
+    """
+    elements = tree.xpath(xpath)
+    if text:
+        elements = _with_text(elements, text)
+    if elements:
+        elements[0].drop_tree()
 
-def parse_articles(soup):
+
+def parse_articles(tree):
     """
     Parse any plans that have a nice article tags
 
@@ -88,19 +102,16 @@ def parse_articles(soup):
     """
 
     # remove table of contents
-    decompose_and_smooth_first(
-        soup,
-        "article",
-        class_=re.compile(r".*DetailPageTableOfContentsBlocks__Container.*"),
+    decompose_first(
+        tree,
+        '//article[contains(@class, "DetailPageTableOfContentsBlocks__Container")]',
     )
 
     # remove calculator section
-    decompose_and_smooth_first(
-        soup, "p", text=re.compile(r"Use this handy calculator.*")
-    )
-    decompose_and_smooth_first(soup, "a", text=re.compile(r"calculator"))
+    decompose_first(tree, "//p", text=CALCULATOR_PARAGRAPH_RE)
+    decompose_first(tree, "//a", text=CALCULATOR_LINK_RE)
 
-    return "\n".join(parse_article(article) for article in soup.findAll("article"))
+    return "\n".join(parse_article(article) for article in tree.xpath("//article"))
 
 
 def parse_article(article):
@@ -112,28 +123,20 @@ def parse_article(article):
     Essence has some very minor issues here because they have the first word of a paragraph
     often separated from the rest of the paragraph
     """
-    for tag in ["a", "b", "i", "u", "em", "strong"]:
-        unwrap_and_smooth(article, tag)
+    unwrap(article, "a", "b", "i", "u", "em", "strong")
 
-    for tag in ["noscript", "img", "button"]:
-        decompose_and_smooth(article, tag)
+    decompose(article, ".//noscript|.//img|.//button|.//script|.//style")
 
     # remove sign up sections
-    decompose_and_smooth(
-        article, "div", class_=re.compile(r".*PlanSignupInterruptorBlocks.*")
-    )
+    decompose(article, './/div[contains(@class, "PlanSignupInterruptorBlocks")]')
 
     # remove "As published on Medium..."
-    decompose_and_smooth_first(
-        article, "p", text=re.compile(r"As published (on Medium|in Essence).*")
-    )
+    decompose_first(article, ".//p", text=AS_PUBLISHED_RE)
 
     # remove paragraphs like "Read expert letter on cost estimate of Medicare for All here"
-    decompose_and_smooth(article, "p", text=re.compile(r"Read expert letter.*here"))
+    decompose(article, ".//p", text=EXPERT_LETTER_RE)
 
-    remove_html_comments(article)
-
-    return article.get_text(separator="\n")
+    return "\n".join(article.itertext())
 
 
 def _flatten(x):
@@ -155,9 +158,9 @@ def _get_contents(contents):
             raise NotImplementedError(f"dont know how to parse {contents}")
 
 
-def parse_medium_dot_com(soup):
+def parse_medium_dot_com(tree):
     print("Parsing Medium article")
-    text = parse_articles(soup)
+    text = parse_articles(tree)
     # manually clean up the one medium article that we're currently parsing
     text_to_strip = "No President Is Above the Law\nTeam Warren\nMay 31 · 5 min read\nBy Elizabeth Warren\n"
     if text.startswith(text_to_strip):
@@ -165,70 +168,74 @@ def parse_medium_dot_com(soup):
     return text
 
 
+def parse_plan(plan_file_path):
+    """
+    Extract text from a single downloaded plan
+
+    :return: plan text record to be written, or None if the plan could not be parsed
+    """
+    logger.info(f"Parsing {plan_file_path}")
+
+    # plan files embed the full page html, so use the faster orjson for reading them
+    with open(plan_file_path, "rb") as plan_file:
+        plan = orjson.loads(plan_file.read())
+    plan_id = plan["id"]
+
+    # if we already have the "full text" of a plan in plans.json for some reason or another
+    if plan.get("full_text"):
+        logger.info(f"Full text already available for {plan_id}")
+        return {"text": plan.get("full_text"), "url": plan["url"], "id": plan_id}
+
+    html = plan["html"]
+
+    plan_hostname = urlparse(plan["url"]).netloc
+
+    page_tree = lxml.html.document_fromstring(html, parser=HTML_PARSER)
+
+    if "medium" in plan_hostname:
+        text = parse_medium_dot_com(page_tree)
+    elif page_tree.find(".//article") is not None:
+        text = parse_articles(page_tree)
+    else:
+        logger.warning(
+            f"Failure to parse {plan_id}. Hostname: {plan_hostname} is not yet supported"
+        )
+        return
+
+    # replace smart quotes and em-dashes ... with their ascii equivalents
+    if not text.isascii():
+        text = unidecode(text)
+
+    return {"text": text, "url": plan["url"], "id": plan_id}
+
+
 def parse_plans():
     """
     Extract text from plan html, preserving whitespace as appropriate
 
     Optimized for Medium posts
+
+    Parsing is CPU-bound and each plan is independent, so plans are parsed across processes
     """
 
     clear_output_dir()
 
-    # Iterate through plans
-    for plan_file_path in plan_file_paths:
-        logger.info(f"Parsing {plan_file_path}")
-
-        with open(plan_file_path) as plan_file:
-            plan = json.load(plan_file)
-        plan_id = plan["id"]
+    with multiprocessing.Pool() as pool:
+        for plan_text in pool.imap_unordered(parse_plan, plan_file_paths, chunksize=4):
+            if not plan_text:
+                continue
 
-        filename = path.join(OUTPUT_DIR, f"{plan_id}.json")
+            filename = path.join(OUTPUT_DIR, f"{plan_text['id']}.json")
 
-        # if we already have the "full text" of a plan in plans.json for some reason or another
-        if plan.get("full_text"):
-            logger.info(f"Full text already available. Writing to {filename}")
+            logger.info(f"Writing plan text to {filename}")
             with open(filename, "w") as plan_text_file:
                 json.dump(
-                    {
-                        "text": plan.get("full_text"),
-                        "url": plan["url"],
-                        "id": plan["id"],
-                    },
+                    plan_text,
                     plan_text_file,
                     sort_keys=True,
                     indent=4,
                     separators=(",", ": "),
                 )
-            continue
-
-        html = plan["html"]
-
-        plan_hostname = urlparse(plan["url"]).netloc
-
-        page_soup = BeautifulSoup(html, "lxml")
-
-        if "medium" in plan_hostname:
-            text = parse_medium_dot_com(page_soup)
-        elif page_soup.find("article"):
-            text = parse_articles(page_soup)
-        else:
-            logger.warning(
-                f"Failure to parse {plan_id}. Hostname: {plan_hostname} is not yet supported"
-            )
-            continue
-
-        # replace smart quotes and em-dashes ... with their ascii equivalents
-        text = unidecode(text)
-
-        logger.info(f"Writing plan text to {filename}")
-        with open(filename, "w") as plan_text_file:
-            json.dump(
-                {"text": text, "url": plan["url"], "id": plan["id"]},
-                plan_text_file,
-                sort_keys=True,
-                indent=4,
-                separators=(",", ": "),
-            )
 
 
 if __name__ == "__main__":
@@ -133,6 +133,14 @@ def update_gensim_models():
     with open(path.join(OUTPUT_DIR, "plan_ids.json"), "w") as plan_id_file:
         json.dump(plan_ids_for_matching, plan_id_file)
 
+    # save preprocessed display titles, so they don't need preprocessing when matching
+    preprocessed_display_titles = {
+        p["display_title"]: Preprocess.preprocess_gensim_v1(p["display_title"])
+        for p in plans_from_repo + plan_clusters
+    }
+    with open(path.join(OUTPUT_DIR, "display_titles.json"), "w") as titles_file:
+        json.dump(preprocessed_display_titles, titles_file)
+
 
 if __name__ == "__main__":
     update_gensim_models()
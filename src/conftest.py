@@ -0,0 +1,8 @@
+import pytest
+
+import llm
+
+
+@pytest.fixture(autouse=True)
+def clear_llm_response_cache():
+    llm._response_cache.clear()
@@ -1,4 +1,5 @@
 import logging
+from collections import OrderedDict
 from typing import Optional
 
 import openai
@@ -9,6 +10,15 @@ MODEL = "gpt-3.5-turbo-16k"  # Need at least 12k tokens in order to fit largest
 
 logger = logging.getLogger(__name__)
 
+# successful responses, by plan id and normalized post text. the same post text
+# summoning the same plan gets the same response (temperature is 0) so don't pay for it twice
+RESPONSE_CACHE_SIZE = 1024
+_response_cache = OrderedDict()
+
+
+def _response_cache_key(plan: PurePlan, post_text: str) -> tuple:
+    return plan["id"], " ".join(post_text.lower().split())
+
 
 class Prompts:
     @staticmethod
@@ -70,6 +80,12 @@ def build_plan_response_text(plan: PurePlan, post_text: str) -> Optional[str]:
     :param post_text: Full text of user post which summoned the bot
     :return: LLM reply to pass to user
     """
+    cache_key = _response_cache_key(plan, post_text)
+    if cache_key in _response_cache:
+        logger.info("Using cached LLM response")
+        _response_cache.move_to_end(cache_key)
+        return _response_cache[cache_key]
+
     logger.info("Generating LLM response")
     messages = [
         {"role": "system", "content": Prompts.planbot_system_prompt()},
@@ -99,4 +115,10 @@ def build_plan_response_text(plan: PurePlan, post_text: str) -> Optional[str]:
 
     logger.info(f"LLM response successful. {post_text=} {response_text=}")
 
+    # failures aren't cached, so they can be retried
+    _response_cache[cache_key] = response_text
+    if len(_response_cache) > RESPONSE_CACHE_SIZE:
+        # evict the least recently used response
+        _response_cache.popitem(last=False)
+
     return response_text
@@ -72,3 +72,22 @@ def test_build_plan_response_text_on__early_stop(mock_plan):
     ) as mock_chat_completion:
         response_text = build_plan_response_text(mock_plan, "foobarbaz")
         assert None is response_text
+
+
+def test_build_plan_response_text_reuses_response_for_same_post(mock_plan):
+    with mock.patch(
+        "openai.ChatCompletion.create",
+        return_value={
+            "choices": [
+                {
+                    "message": {"content": "This is indeed a test"},
+                    "finish_reason": "stop",
+                }
+            ]
+        },
+    ) as mock_chat_completion:
+        build_plan_response_text(mock_plan, "foo bar baz")
+        response_text = build_plan_response_text(mock_plan, "Foo  bar baz")
+
+    assert "This is indeed a test" == response_text
+    mock_chat_completion.assert_called_once()
@@ -3,7 +3,6 @@
 import json
 import logging
 import os
-import re
 import time
 
 import click
@@ -13,7 +12,8 @@ from google.cloud import firestore
 
 import pushshift
 import reddit_util
-from plan_bot import process_post
+from matching import lsa_gensim_v3_models
+from plan_bot import process_post, wait_for_db_writes
 from plans import load_plans
 
 logger = logging.getLogger(__name__)
@@ -30,6 +30,9 @@ click_kwargs = {"show_envvar": True, "show_default": True}
 
 POST_IDS_PROCESSED = set()
 
+# Any mention of the bot (!WarrenPlanBot, /u/WarrenPlanBot) makes a comment worth processing
+BOT_MENTION = "warrenplanbot"
+
 
 @click.command()
 @click.option(
@@ -140,11 +143,15 @@ def run_plan_bot(
 
     plans = load_plans()
 
+    # load the matching models now, so the first summons doesn't wait on them
+    lsa_gensim_v3_models()
+
     with open(VERBATIMS_FILE) as json_file:
         verbatims = json.load(json_file)
 
     if skip_tracking:
         posts_db = None
+        db = None
         comments_progress_ref = None
     else:
         db = firestore.Client(project=project)
@@ -154,13 +161,20 @@ def run_plan_bot(
         # get post ids from database only if we don't already have them
         if not POST_IDS_PROCESSED:
             # Load the list of posts processed to or start with empty list if none
-            posts_processed = posts_db.where("processed", "==", True).stream()
+            # Only the ids are needed, so project to the document name rather than
+            # downloading every field of the full post history
+            posts_processed = (
+                posts_db.where("processed", "==", True).select(["__name__"]).stream()
+            )
 
             POST_IDS_PROCESSED.update({post.id for post in posts_processed})
 
         # Track progress of comments
         comments_progress_ref = db.collection("progress").document("comments")
 
+    # Records for skipped posts are written together at the end of the pass
+    skipped_post_writes = []
+
     process_the_post = lambda post: process_post(
         post,
         plans,
@@ -170,6 +184,7 @@ def run_plan_bot(
         send=send_replies,
         simulate=simulate_replies,
         skip_tracking=skip_tracking,
+        skipped_post_writes=skipped_post_writes,
     )
 
     subreddit_name = "ElizabethWarren" if praw_site == "prod" else "WPBSandbox"
@@ -177,48 +192,84 @@ def run_plan_bot(
     # Get the subreddit
     subreddit = reddit.subreddit(subreddit_name)
 
-    # Get the number of new submissions up to the limit
-    # Note: If this gets slow, we could switch this to pushshift
-    for submission in subreddit.search(
-        "warrenplanbot", sort="new", time_filter="all", limit=limit
-    ):
-        # turn this into our more standardized class
-        submission = reddit_util.Submission(submission)
-        process_the_post(submission)
-
-    # FIXME: pushshift is only for moderators since Reddit API changes. replace to get deeper comment history than via the Reddit API below
-    #  https://www.reddit.com/r/pushshift/comments/14ei799/pushshift_live_again_and_how_moderators_can/
-    # for pushshift_comment in pushshift.search_comments(
-    #     "warrenplanbot", subreddit_name, limit=limit
-    # ):
-    #
-    #     comment = reddit_util.Comment(
-    #         praw.models.Comment(reddit, _data=pushshift_comment)
-    #     )
-    #
-    #     process_the_post(comment)
-
-    # Get new comments since we last ran.
-    #
-    # subreddit.comments() returns the newest comments first so we
-    # need to reverse it so that the comments we're iterating over are getting newer.
-    # With no specified params, it returns newest 100 comments in the
-    # subreddit.
-    comments_params = get_comments_params(comments_progress_ref)
-    for comment in reversed(list(subreddit.comments(params=comments_params))):
-        comment = reddit_util.Comment(comment)
-        if re.search("warrenplanbot", comment.text, re.IGNORECASE):
-            process_the_post(comment)
-
-        # update the cursor after processing the comment
-        if not skip_tracking:
-            comments_progress_ref.set({"newest": comment.fullname}, merge=True)
+    def finish_pass():
+        # make sure the records of every post are written before moving the cursor past them
+        wait_for_db_writes()
+        write_skipped_posts(db, skipped_post_writes)
+
+        # update the cursor once, to the newest comment we got through,
+        # rather than making a db write after every comment
+        if newest_comment_fullname and not skip_tracking:
+            comments_progress_ref.set({"newest": newest_comment_fullname}, merge=True)
+
+    newest_comment_fullname = None
+    try:
+        # Get the number of new submissions up to the limit
+        # Note: If this gets slow, we could switch this to pushshift
+        for submission in subreddit.search(
+            "warrenplanbot", sort="new", time_filter="all", limit=limit
+        ):
+            # turn this into our more standardized class
+            submission = reddit_util.Submission(submission)
+            process_the_post(submission)
+
+        # FIXME: pushshift is only for moderators since Reddit API changes. replace to get deeper comment history than via the Reddit API below
+        #  https://www.reddit.com/r/pushshift/comments/14ei799/pushshift_live_again_and_how_moderators_can/
+        # for pushshift_comment in pushshift.search_comments(
+        #     "warrenplanbot", subreddit_name, limit=limit
+        # ):
+        #
+        #     comment = reddit_util.Comment(
+        #         praw.models.Comment(reddit, _data=pushshift_comment)
+        #     )
+        #
+        #     process_the_post(comment)
+
+        # Get new comments since we last ran.
+        #
+        # subreddit.comments() returns the newest comments first so we
+        # need to reverse it so that the comments we're iterating over are getting newer.
+        # With no specified params, it returns newest 100 comments in the
+        # subreddit.
+        comments_params = get_comments_params(comments_progress_ref)
+        for comment in reversed(list(subreddit.comments(params=comments_params))):
+            # skip comments we've already processed before doing any work on them
+            if comment.id not in POST_IDS_PROCESSED:
+                comment = reddit_util.Comment(comment)
+                if BOT_MENTION in comment.text.lower():
+                    process_the_post(comment)
+
+            newest_comment_fullname = comment.fullname
+    except BaseException:
+        # still finish what we can of the pass, but the error that stopped it is the one to raise
+        try:
+            finish_pass()
+        except Exception:
+            logger.exception("Failed to finish db writes for the failed pass")
+        raise
+
+    finish_pass()
 
     logger.info(
         f"Single pass of plan bot took: {round(time.time() - pass_start_time, 2)}s"
     )
 
 
+def write_skipped_posts(db, skipped_post_writes):
+    """
+    Write the records of skipped posts in a single batch. Committing a batch is a
+    round-trip even when it's empty, so nothing is sent if no posts were skipped
+    """
+    if not skipped_post_writes:
+        return
+
+    batch = db.batch()
+    for document, record in skipped_post_writes:
+        batch.set(document, record)
+    batch.commit()
+    skipped_post_writes.clear()
+
+
 def get_comments_params(comments_progress_ref):
     if comments_progress_ref:
         comments_progress = comments_progress_ref.get()
@@ -4,7 +4,6 @@ import re
 from functools import lru_cache, partial
 from os import path
 
-from fuzzywuzzy import fuzz
 from gensim import corpora, models, similarities
 from gensim.parsing.preprocessing import STOPWORDS as GENSIM_STOPWORDS
 from gensim.parsing.preprocessing import (
@@ -15,12 +14,17 @@ from gensim.parsing.preprocessing import (
     strip_punctuation,
     strip_short,
 )
+from rapidfuzz import fuzz, process
 from unidecode import unidecode
 
 DIRNAME = path.dirname(path.realpath(__file__))
 
 GENSIM_V3_MODELS_PATH = path.abspath(path.join(DIRNAME, "models/gensim_strategy_v3"))
 
+# number of most similar documents to consider when matching. each plan has at most 3
+# documents in the index, so this always covers the 8 potential matches we show in replies
+GENSIM_NUM_BEST = 24
+
 # suppress gensim logs
 logging.getLogger("gensim").setLevel(logging.WARNING)
 
@@ -42,6 +46,53 @@ CUSTOM_STOPWORDS = {
 }
 
 
+# Rule matching patterns. These are checked against every post, so compile them once
+WHY_WARREN_RE = re.compile(r"why warren\W*$", re.IGNORECASE | re.MULTILINE)
+HELP_RE = re.compile(r"(advanced\s+)?help\W*$", re.IGNORECASE | re.MULTILINE)
+SHOW_ME_THE_PLANS_RE = re.compile(
+    r"show me the plans\W*$", re.IGNORECASE | re.MULTILINE
+)
+STATE_OF_RACE_RE = re.compile(
+    r"state of (?:the )?(?:race|primary)\W*$", re.IGNORECASE | re.MULTILINE
+)
+IS_RACE_OVER_RE = re.compile(
+    r"is the (?:race|primary) over\W*$", re.IGNORECASE | re.MULTILINE
+)
+STATUS_CHECK_RE = re.compile(r"status check\W*$", re.IGNORECASE | re.MULTILINE)
+
+# Words that any post matching the corresponding rule patterns above must contain.
+# Checking for them is much cheaper than running the patterns, and most posts contain none
+VERBATIM_KEYWORDS = ("warren", "help")
+PLAN_LIST_KEYWORDS = ("plans",)
+STATE_OF_RACE_KEYWORDS = ("race", "primary", "status")
+
+
+# fuzzywuzzy's full_process(force_ascii=True), which topics were tuned against, dropped
+# these latin-1 characters and replaced anything that isn't a word character with a space
+FUZZ_DROPPED_CHARS = dict.fromkeys(range(128, 256))
+FUZZ_NON_WORD_RE = re.compile(r"\W")
+
+
+def _fuzz_process(text: str) -> str:
+    return FUZZ_NON_WORD_RE.sub(" ", text.translate(FUZZ_DROPPED_CHARS)).lower().strip()
+
+
+def _rounded_token_sort_ratio(s1: str, s2: str, **kwargs) -> int:
+    """
+    token_sort_ratio rounded to a whole score, like fuzzywuzzy's, so the first
+    of plans scoring the same rounded score is the best match
+    """
+    return round(fuzz.token_sort_ratio(s1, s2, **kwargs))
+
+
+def _contains_any(text: str, keywords: tuple) -> bool:
+    """
+    Whether the text contains any of the lowercase keywords, ignoring case
+    """
+    text = text.lower()
+    return any(keyword in text for keyword in keywords)
+
+
 class Preprocess:
     """
     Defines strategies used for preprocessing text before model building and similarity scoring
@@ -49,14 +100,35 @@ class Preprocess:
     Strategies must each accept a string and return a string
     """
 
+    @staticmethod
+    def _to_ascii(s):
+        # unidecode scans every character in python, so skip it for text that's already ascii
+        return s if s.isascii() else unidecode(s)
+
     @staticmethod
     def _remove_stopwords(s, stopwords=CUSTOM_STOPWORDS):
         return " ".join(w for w in s.split() if w.lower() not in stopwords)
 
     @staticmethod
     def preprocess_gensim_v1(doc):
+        return list(Preprocess._preprocess_gensim_v1(doc))
+
+    @staticmethod
+    def preprocess_gensim_v1_tuple(doc) -> tuple:
+        """
+        preprocess_gensim_v1 as a tuple. Cheaper when the result is only compared, since it's
+        the cached value itself rather than a fresh copy
+        """
+        return Preprocess._preprocess_gensim_v1(doc)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _preprocess_gensim_v1(doc) -> tuple:
+        """
+        Cached implementation of preprocess_gensim_v1. Returns a tuple so cached values can't be mutated
+        """
         preprocessing_filters = [
-            unidecode,
+            Preprocess._to_ascii,
             lambda x: x.lower(),
             strip_punctuation,
             strip_multiple_whitespaces,
@@ -67,23 +139,86 @@ class Preprocess:
             stem_text,  # This is the Porter stemmer
         ]
 
-        return preprocess_string(doc, preprocessing_filters)
+        return tuple(preprocess_string(doc, preprocessing_filters))
 
     @staticmethod
     def preprocess_gensim_v3(doc):
+        return list(Preprocess._preprocess_gensim_v3(doc))
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _preprocess_gensim_v3(doc) -> tuple:
+        """
+        Cached implementation of preprocess_gensim_v3. Returns a tuple so cached values can't be mutated
+        """
         preprocessed_v1 = Preprocess.preprocess_gensim_v1(doc)
 
-        return preprocessed_v1 + Preprocess.bigrams(preprocessed_v1)
+        return tuple(preprocessed_v1 + Preprocess.bigrams(preprocessed_v1))
 
     @staticmethod
     def bigrams(list_of_words: list) -> list:
         """
         Turn a list of words into a list of bigrams
         """
-        return [
-            f"{list_of_words[i]} {list_of_words[i+1]}"
-            for i in range(len(list_of_words) - 1)
-        ]
+        return list(map(" ".join, zip(list_of_words, list_of_words[1:])))
+
+
+def _load_gensim_models(model_name, model, similarity, model_path):
+    with open(path.join(model_path, "plan_ids.json")) as plan_ids_file:
+        plan_ids = json.load(plan_ids_file)
+
+    dictionary = corpora.Dictionary.load(path.join(model_path, "plans.dict"))
+
+    index = similarity.load(path.join(model_path, f"{model_name}.index"))
+    # only return the top results. note these are ranked by absolute similarity,
+    # so they can include negatively correlated documents
+    index.num_best = GENSIM_NUM_BEST
+    model = model.load(path.join(model_path, f"{model_name}.model"))
+
+    return plan_ids, dictionary, index, model
+
+
+# Precomputed models are static for the life of the bot, so they're loaded once on first use.
+# They aren't loaded at import so scripts can import this module before the models exist
+_GENSIM_V3_MODELS = {}
+
+
+def _gensim_v3_models(model_name, model, similarity):
+    """
+    The (plan_ids, dictionary, index, model) tuple for a v3 model, loading it on first use
+    """
+    if model_name not in _GENSIM_V3_MODELS:
+        _GENSIM_V3_MODELS[model_name] = _load_gensim_models(
+            model_name, model, similarity, GENSIM_V3_MODELS_PATH
+        )
+    return _GENSIM_V3_MODELS[model_name]
+
+
+def lsa_gensim_v3_models():
+    """
+    The models used by Strategy.lsa_gensim_v3. The bot calls this at startup so they're
+    loaded then, rather than on the first post it matches
+    """
+    return _gensim_v3_models("lsa", models.LsiModel, similarities.MatrixSimilarity)
+
+
+def _load_preprocessed_display_titles(model_path):
+    """
+    Load display titles preprocessed by preprocess_gensim_v1. Any titles not found in
+    here (or if the file hasn't been generated yet) are preprocessed when matching
+    """
+    titles_path = path.join(model_path, "display_titles.json")
+    if not path.exists(titles_path):
+        return {}
+
+    with open(titles_path) as titles_file:
+        return {
+            display_title: tuple(preprocessed_title)
+            for display_title, preprocessed_title in json.load(titles_file).items()
+        }
+
+
+PREPROCESSED_DISPLAY_TITLES = _load_preprocessed_display_titles(GENSIM_V3_MODELS_PATH)
 
 
 class Strategy:
@@ -116,21 +251,25 @@ class Strategy:
     @staticmethod
     def token_sort_ratio(plans: list, post_text, threshold=50, **kwargs):
         """
-        Match plans based on hardcoded plan topics, using fuzzywuzzy's token_sort_ratio for fuzzy matching
+        Match plans based on hardcoded plan topics, using rapidfuzz's token_sort_ratio for fuzzy matching
         """
 
         match_confidence = 0
         match = None
 
-        for plan in plans:
-            plan_match_confidence = fuzz.token_sort_ratio(
-                post_text.lower(), plan["topic"].lower()
-            )
+        # score every topic in one call. the post and each topic are processed the way
+        # fuzzywuzzy did. extractOne stops scanning as soon as a topic scores a perfect
+        # 100, so verbatim topic requests don't score the remaining plans
+        best_topic_match = process.extractOne(
+            post_text,
+            [plan["topic"] for plan in plans],
+            scorer=_rounded_token_sort_ratio,
+            processor=_fuzz_process,
+        )
 
-            if plan_match_confidence > match_confidence:
-                # Update match
-                match_confidence = plan_match_confidence
-                match = plan
+        if best_topic_match and best_topic_match[1] > 0:
+            _, match_confidence, plan_index = best_topic_match
+            match = plans[plan_index]
 
         return {
             "match": match["id"] if match_confidence > threshold else None,
@@ -150,77 +289,69 @@ class Strategy:
                 return match_info
         return match_info
 
-    @staticmethod
-    @lru_cache(maxsize=8)
-    def _load_gensim_models(model_name, model, similarity, model_path):
-        plan_ids = json.load(open(path.join(model_path, "plan_ids.json")))
-
-        dictionary = corpora.Dictionary.load(path.join(model_path, "plans.dict"))
-
-        index = similarity.load(path.join(model_path, f"{model_name}.index"))
-        model = model.load(path.join(model_path, f"{model_name}.model"))
-
-        return plan_ids, dictionary, index, model
-
     @staticmethod
     def _gensim_similarity(
         plans: list,
         post_text: str,
-        model_name,
-        model,
-        similarity,
+        gensim_models: tuple,
         threshold,
         potential_plan_threshold=50,
-        model_path=GENSIM_V3_MODELS_PATH,
         preprocess=Preprocess.preprocess_gensim_v1,
         **kwargs,
     ):
-        plan_ids, dictionary, index, model = Strategy._load_gensim_models(
-            model_name, model, similarity, model_path
-        )
+        plan_ids, dictionary, index, model = gensim_models
 
         preprocessed_post = preprocess(post_text)
 
         vec_post = dictionary.doc2bow(preprocessed_post)
 
-        # find similar plans
-        sims = index[model[vec_post]]
-        # sort by descending match
-        sims = list(sorted(enumerate(sims), key=lambda item: -item[1]))
-
-        potential_matches_with_dups = [
-            {
-                "plan_id": plan_ids[sim[0]],
-                "plan": next(
-                    filter(lambda p: p["id"] == plan_ids[sim[0]], plans), None
-                ),
-                "confidence": sim[1] * 100,
-            }
-            for sim in sims
-        ]
-
-        # dedupe potential matches
+        # find similar plans. the index ranks them by absolute similarity, so drop
+        # negatively correlated documents and sort what's left by descending match.
+        # if nothing is similar at all, fall back to the first document to still
+        # have a (zero confidence) best match
+        sims = sorted(
+            (sim for sim in index[model[vec_post]] if sim[1] > 0),
+            key=lambda sim: sim[1],
+            reverse=True,
+        ) or [(0, 0.0)]
+
+        plans_by_id = {plan["id"]: plan for plan in plans}
+
+        # sims are sorted by descending match, so in a single pass the first
+        # occurrence of a plan is its best match, and we can stop once we've
+        # dropped below the potential plan threshold
+        best_match = None
         potential_plan_ids = set()
         potential_matches = []
-        for potential_match in potential_matches_with_dups:
-            if potential_match["plan_id"] not in potential_plan_ids:
-                potential_matches.append(potential_match)
-                potential_plan_ids.add(potential_match["plan_id"])
+        for plan_index, similarity_score in sims:
+            plan_id = plan_ids[plan_index]
+            if plan_id in potential_plan_ids:
+                continue
+            potential_plan_ids.add(plan_id)
+
+            potential_match = {
+                "plan_id": plan_id,
+                "plan": plans_by_id.get(plan_id),
+                "confidence": similarity_score * 100,
+            }
+
+            if best_match is None:
+                best_match = potential_match
+
+            if potential_match["confidence"] <= potential_plan_threshold:
+                break
+
+            potential_matches.append(potential_match)
 
-        best_match_confidence = potential_matches[0]["confidence"]
-        best_match_plan = potential_matches[0]["plan"]
-        best_match_plan_id = potential_matches[0]["plan_id"]
+        best_match_confidence = best_match["confidence"]
+        best_match_plan = best_match["plan"]
+        best_match_plan_id = best_match["plan_id"]
 
         return {
             "match": best_match_plan_id if best_match_confidence > threshold else None,
             "confidence": best_match_confidence,
             "plan": best_match_plan,
-            "potential_matches": list(
-                filter(
-                    lambda m: m["confidence"] > potential_plan_threshold,
-                    potential_matches,
-                )
-            ),
+            "potential_matches": potential_matches,
         }
 
     @staticmethod
@@ -236,12 +367,9 @@ class Strategy:
         return Strategy._gensim_similarity(
             plans,
             post_text,
-            "lsa",
-            models.LsiModel,
-            similarities.MatrixSimilarity,
+            lsa_gensim_v3_models(),
             threshold,
             preprocess=Preprocess.preprocess_gensim_v3,
-            model_path=GENSIM_V3_MODELS_PATH,
             **kwargs,
         )
 
@@ -257,11 +385,10 @@ class Strategy:
         return Strategy._gensim_similarity(
             plans,
             post_text,
-            "tfidf",
-            models.TfidfModel,
-            similarities.MatrixSimilarity,
+            _gensim_v3_models(
+                "tfidf", models.TfidfModel, similarities.MatrixSimilarity
+            ),
             threshold,
-            model_path=GENSIM_V3_MODELS_PATH,
             preprocess=Preprocess.preprocess_gensim_v3,
             **kwargs,
         )
@@ -282,14 +409,14 @@ class RuleStrategy:
         Match exactly to a verbatim message's ID.
         """
         verbatim_id = None
-        if "why_warren" in options or re.match(
-            r"why warren\W*$", post_text, re.IGNORECASE | re.MULTILINE
-        ):
+        if "why_warren" in options:
+            verbatim_id = "why_warren"
+        elif not _contains_any(post_text, VERBATIM_KEYWORDS):
+            return
+        elif WHY_WARREN_RE.match(post_text):
             verbatim_id = "why_warren"
         else:
-            match = re.match(
-                r"(advanced\s+)?help\W*$", post_text, re.IGNORECASE | re.MULTILINE
-            )
+            match = HELP_RE.match(post_text)
             if match:
                 if match.group(1):
                     verbatim_id = "advanced_help"
@@ -306,12 +433,16 @@ class RuleStrategy:
         Exact display title matches. Include some preprocessing just to allow punctuation to be imperfect,
         or the user to include a stop word for some reason
         """
-        preprocessed_post = Preprocess.preprocess_gensim_v1(post_text)
+        preprocessed_post = Preprocess.preprocess_gensim_v1_tuple(post_text)
         for plan in plans:
-            if (
-                Preprocess.preprocess_gensim_v1(plan["display_title"])
-                == preprocessed_post
-            ):
+            # display titles of known plans were preprocessed along with the models
+            preprocessed_title = PREPROCESSED_DISPLAY_TITLES.get(plan["display_title"])
+            if preprocessed_title is None:
+                preprocessed_title = Preprocess.preprocess_gensim_v1_tuple(
+                    plan["display_title"]
+                )
+
+            if preprocessed_title == preprocessed_post:
                 return {"match": plan["id"], "confidence": 100, "plan": plan}
 
     @staticmethod
@@ -319,7 +450,9 @@ class RuleStrategy:
         """
         Matches strictly to a request at the end of the trigger line for the full list of all known plans
         """
-        if re.search(r"show me the plans\W*$", post_text, re.IGNORECASE | re.MULTILINE):
+        if _contains_any(post_text, PLAN_LIST_KEYWORDS) and SHOW_ME_THE_PLANS_RE.search(
+            post_text
+        ):
             return {"operation": "all_the_plans"}
 
     @staticmethod
@@ -329,18 +462,12 @@ class RuleStrategy:
         """
         Matches strictly to a request at the end of the trigger line for the state of the race
         """
-        if (
-            "state_of_race" in options
-            or re.search(
-                r"state of (?:the )?(?:race|primary)\W*$",
-                post_text,
-                re.IGNORECASE | re.MULTILINE,
-            )
-            or re.search(
-                r"is the (?:race|primary) over\W*$",
-                post_text,
-                re.IGNORECASE | re.MULTILINE,
+        if "state_of_race" in options or (
+            _contains_any(post_text, STATE_OF_RACE_KEYWORDS)
+            and (
+                STATE_OF_RACE_RE.search(post_text)
+                or IS_RACE_OVER_RE.search(post_text)
+                or STATUS_CHECK_RE.search(post_text)
             )
-            or re.search(r"status check\W*$", post_text, re.IGNORECASE | re.MULTILINE)
         ):
             return {"operation": "state_of_race"}
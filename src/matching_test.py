@@ -1,4 +1,4 @@
-from matching import Preprocess, RuleStrategy
+from matching import Preprocess, RuleStrategy, Strategy, _fuzz_process
 
 
 class MockComment:
@@ -19,6 +19,31 @@ VERBATIMS = [
 ]
 
 
+PLANS = [
+    {"id": "century_21", "topic": "21st century title"},
+    {"id": "another_plan", "topic": "another plan"},
+    {"id": "another_plan_again", "topic": "another plan"},
+]
+
+
+class TestStrategy:
+    def test_token_sort_ratio_perfect_match(self):
+        match_info = Strategy.token_sort_ratio(PLANS, "Plan, another!")
+
+        assert match_info["match"] == "another_plan"
+        assert match_info["confidence"] == 100
+        assert match_info["plan"] is PLANS[1]
+
+    def test_token_sort_ratio_no_match(self):
+        match_info = Strategy.token_sort_ratio(PLANS, "zzz")
+
+        assert match_info["match"] is None
+        assert match_info["plan"] is None
+
+    def test_token_sort_ratio_drops_latin_1_characters_like_fuzzywuzzy(self):
+        assert _fuzz_process(" Café naïve_plan, ÑOW! ") == "caf nave_plan  ow"
+
+
 class TestRuleStrategy:
     show_me_the_plans_operation = {"operation": "all_the_plans"}
     state_of_race_operation = {"operation": "state_of_race"}
@@ -154,3 +179,12 @@ class TestRuleStrategy:
 class TestPreprocess:
     def test_bigrams(self):
         assert Preprocess.bigrams(["foo", "bar", "baz"]) == ["foo bar", "bar baz"]
+
+    def test_preprocess_gensim_v1_returns_fresh_list(self):
+        preprocessed = Preprocess.preprocess_gensim_v1("Universal Child Care")
+        preprocessed.append("foo")
+        assert Preprocess.preprocess_gensim_v1("Universal Child Care") == [
+            "univers",
+            "child",
+            "care",
+        ]
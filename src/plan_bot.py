@@ -1,37 +1,123 @@
-import argparse
+import concurrent.futures
 import datetime
 import logging
 import re
-from functools import partial
+from functools import lru_cache
 
 from google.cloud import firestore
 from praw.exceptions import APIException
 
 import llm
 from matching import RuleStrategy, Strategy
-from plans import Plan, PlanCluster, PurePlan
+from plans import Plan, PlanCluster, Plans, PurePlan
 from reddit_util import standardize
 
 logger = logging.getLogger(__name__)
 
+# lowercase, so it can be checked for with a plain substring search of lowercased text
+TRIGGER_WORD = "!warrenplanbot"
 
-def parent_reply_prefix(post):
-    return f"/u/{post.author.name} asked me to chime in!" f"\n\n"
+# every account the bot runs as (WarrenPlanBot, WarrenPlanBotDev...) starts with this, lowercased
+BOT_USERNAME_PREFIX = "warrenplanbot"
 
+# flags which can be given before the text of a post, and the option each one sets
+FLAGS = {
+    "--parent": "parent",
+    "--tell-parent": "parent",
+    "--why-warren": "why_warren",
+    "--state-of-race": "state_of_race",
+    "--state-of-the-race": "state_of_race",
+    "--status-check": "state_of_race",
+}
 
-def footer():
-    return (
-        f"\n\n"
-        # Horizontal line above footer
-        "\n***\n"
-        # Disclaimer
-        f"This bot was created independently by volunteers. [Join us!](https://elizabethwarren.com/join-us) "
-    )
+# text starting with a dash which still isn't a flag
+NEGATIVE_NUMBER_RE = re.compile(r"^-\d+$|^-\d*\.\d+$")
+
+# operations which can be requested instead of a plan, and have their own responses
+OPERATIONS = {"verbatim", "all_the_plans", "state_of_race"}
+
+# Firestore writes are network round-trips, so they're made in the background
+# while posts keep being processed. the client is thread-safe
+_db_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+_pending_db_writes = []
+
+
+def _write_in_background(fn, *args) -> concurrent.futures.Future:
+    future = _db_pool.submit(fn, *args)
+    _pending_db_writes.append(future)
+    return future
+
+
+def wait_for_db_writes():
+    """
+    Block until all background db writes made by process_post are done,
+    raising the first error any of them hit
+    """
+    pending = _pending_db_writes[:]
+    _pending_db_writes.clear()
+    for future in pending:
+        future.result()
+
+
+PARENT_REPLY_PREFIX = "/u/{} asked me to chime in!\n\n"
+
+FOOTER = (
+    "\n\n"
+    # Horizontal line above footer
+    "\n***\n"
+    # Disclaimer
+    "This bot was created independently by volunteers. [Join us!](https://elizabethwarren.com/join-us) "
+)
+
+LLM_FOOTER = (
+    "\n\n"
+    # Horizontal line above footer
+    "\n***\n"
+    # Disclaimer
+    "This bot was created independently by volunteers and used LLMs in generating this response. If anything is incorrect, please reply and let us know."
+)
+
+SHOW_ME_THE_PLANS_HINT = "```!WarrenPlanBot show me the plans```"
+
+NO_MATCH_HEADER = (
+    "I'm not sure I have an exact match for you! "
+    "Here are the plans that seem most relevant:"
+    "\n\n"
+)
+
+NO_MATCH_FOOTER = (
+    "\n\n"
+    "Or I can show you my full list of her plans if you reply with"
+    "\n\n"
+    f"{SHOW_ME_THE_PLANS_HINT}"
+    "\n\n"
+    f"{FOOTER}"
+)
+
+NO_MATCH_NO_POTENTIAL_MATCHES = (
+    "I'm not sure exactly which plan you're looking for, "
+    "and I'm not feeling confident enough in any of my guesses to tell you about them! ':("
+    "\n\n"
+    "I can show you my full list of her plans if you reply with"
+    "\n\n"
+    f"{SHOW_ME_THE_PLANS_HINT}"
+    "\n\n"
+    "Or please kindly rephrase? ':D"
+    f"{FOOTER}"
+)
+
+ALL_PLANS_HEADER = (
+    "Here's the full list of plans Sen. Warren has released that I know about:" "\n\n"
+)
+
+
+def parent_reply_prefix(post):
+    return PARENT_REPLY_PREFIX.format(post.author.name)
 
 
 def _plan_links(plans: list[Plan]) -> str:
     return "\n".join(
-        ["[" + plan["display_title"] + "](" + plan["url"] + ")  " for plan in plans]
+        "[" + plan["display_title"] + "](" + plan["url"] + ")  " for plan in plans
     )
 
 
@@ -47,26 +133,36 @@ def build_response_text_plan_cluster(plan_cluster: PlanCluster):
         f"Learn more about her plans for {plan_cluster['display_title']}:"
         f"\n\n"
         f"{ _plan_links(plan_cluster['plans'])}"
-        f"{footer()}"
+        f"{FOOTER}"
     )
 
 
-def build_response_text_pure_plan(plan: PurePlan):
+def _build_response_text_single_plan(
+    plan: PurePlan, plan_text: str, footer_text: str
+) -> str:
     """
-    Create response text with plan summary
+    Create response text for a single plan, describing the plan with plan_text
     """
 
     return (
         f"Senator Warren has a plan for that!"
         f"\n\n"
-        f"{plan['summary']}"
+        f"{plan_text}"
         f"\n\n"
         # Link to learn more about the plan
         f"Learn more about her plan: [{plan['display_title']}]({plan['url']})"
-        f"{footer()}"
+        f"{footer_text}"
     )
 
 
+def build_response_text_pure_plan(plan: PurePlan):
+    """
+    Create response text with plan summary
+    """
+
+    return _build_response_text_single_plan(plan, plan["summary"], FOOTER)
+
+
 def build_response_text_llm(plan: PurePlan, full_post_text: str) -> str:
     """
     Create response text using llm to include contextual information
@@ -77,18 +173,7 @@ def build_response_text_llm(plan: PurePlan, full_post_text: str) -> str:
     if not llm_response:
         return
 
-    return (
-        f"Senator Warren has a plan for that!"
-        f"\n\n"
-        f"{llm_response}"
-        f"\n\n"
-        f"Learn more about her plan: [{plan['display_title']}]({plan['url']})"
-        f"\n\n"
-        # Horizontal line above footer
-        "\n***\n"
-        # Disclaimer
-        f"This bot was created independently by volunteers and used LLMs in generating this response. If anything is incorrect, please reply and let us know."
-    )
+    return _build_response_text_single_plan(plan, llm_response, LLM_FOOTER)
 
 
 def build_plan_response_text(plan: Plan, full_post_text: str) -> (str, str):
@@ -114,60 +199,51 @@ def build_plan_response_text(plan: Plan, full_post_text: str) -> (str, str):
 
 
 def build_verbatim_response_text(verbatim):
-    return f"""{verbatim["text"]}{footer()}"""
+    return verbatim["text"] + FOOTER
 
 
 def build_no_match_response_text(potential_plan_matches: list[Plan], post):
     if potential_plan_matches:
         return (
-            f"I'm not sure I have an exact match for you! "
-            f"Here are the plans that seem most relevant:"
-            f"\n\n"
-            f"{ _plan_links(match['plan'] for match in potential_plan_matches[:8])}"
-            f"\n\n"
-            f"Or I can show you my full list of her plans if you reply with"
-            f"\n\n"
-            f"```"
-            f"!WarrenPlanBot show me the plans"
-            f"```"
-            f"\n\n"
-            f"{footer()}"
+            NO_MATCH_HEADER
+            + _plan_links(match["plan"] for match in potential_plan_matches[:8])
+            + NO_MATCH_FOOTER
         )
     else:
-        return (
-            f"I'm not sure exactly which plan you're looking for, "
-            f"and I'm not feeling confident enough in any of my guesses to tell you about them! ':("
-            f"\n\n"
-            f"I can show you my full list of her plans if you reply with"
-            f"\n\n"
-            f"```"
-            f"!WarrenPlanBot show me the plans"
-            f"```"
-            f"\n\n"
-            f"Or please kindly rephrase? ':D"
-            f"{footer()}"
-        )
+        return NO_MATCH_NO_POTENTIAL_MATCHES
 
 
-def build_all_plans_response_text(plans: list[Plan]) -> str:
-    pure_plans = list(filter(lambda p: not p.get("is_cluster"), plans))
+def build_all_plans_response_text(plans: Plans) -> str:
+    pure_plans = plans.pure
 
-    response = (
-        f"Here's the full list of plans Sen. Warren has released that I know about:"
-        f"\n\n"
-        f"|[{pure_plans[0]['display_title']}]({pure_plans[0]['url']})|[{pure_plans[1]['display_title']}]({pure_plans[1]['url']})|[{pure_plans[2]['display_title']}]({pure_plans[2]['url']})|"
+    # plans are reloaded every pass, so the response is cached on what the table shows
+    # rather than on the list itself
+    return _build_all_plans_response_text(
+        tuple((plan["display_title"], plan["url"]) for plan in pure_plans)
+    )
+
+
+@lru_cache(maxsize=1)
+def _build_all_plans_response_text(plan_links: tuple) -> str:
+    """
+    :param plan_links: (display_title, url) of every pure plan, in order
+    """
+    # collect the pieces and join them once, rather than growing the response a cell at a time
+    response = [
+        f"{ALL_PLANS_HEADER}"
+        f"|[{plan_links[0][0]}]({plan_links[0][1]})|[{plan_links[1][0]}]({plan_links[1][1]})|[{plan_links[2][0]}]({plan_links[2][1]})|"
         f"\n"
         f"|:-:|:-:|:-:|"
         f"\n"
-    )
-    for i, plan in enumerate(pure_plans[3:], start=3):
-        response += f"|[{plan['display_title']}]({plan['url']})"
+    ]
+    for i, (display_title, url) in enumerate(plan_links[3:], start=3):
+        response.append(f"|[{display_title}]({url})")
         if (i + 1) % 3 == 0:
-            response += "|\n"
+            response.append("|\n")
 
-    response += f"\n\n" f"{footer()}"
+    response.append(f"\n\n" f"{FOOTER}")
 
-    return response
+    return "".join(response)
 
 
 def day_suffix(d):
@@ -178,6 +254,7 @@ def custom_strftime(format, t):
     return t.strftime(format).replace("{S}", str(t.day) + day_suffix(t.day))
 
 
+@lru_cache(maxsize=8)
 def build_state_of_race_response_text(today: datetime.date) -> str:
     if today > datetime.date(2020, 3, 6):
         return "rip."
@@ -233,43 +310,73 @@ def process_post(
     simulate=False,
     skip_tracking=False,
     matching_strategy=Strategy.lsa_gensim_v3,
+    skipped_post_writes=None,
 ):
+    """
+    :param skipped_post_writes: optional list. If given, (document, record) pairs for skipped posts
+      are appended to it rather than written immediately, and the caller is responsible for writing them
+    """
     if post_ids_processed is None:
         post_ids_processed = set()
 
+    # post attributes are looked up through the praw wrappers on each access
+    # (and submission text is rebuilt), so only look them up once
+    post_id = post.id
+
     # Make sure we don't reply to a post we've already processed
-    if post.id in post_ids_processed:
+    if post_id in post_ids_processed:
         return
 
-    logger.info(f"Processing post {post.type}: {post.id}")
+    full_post_text = post.text
+    post_type = post.type
+    author = post.author
+
+    logger.info(f"Processing post {post_type}: {post_id}")
 
     # Add this post to the set of processed posts
-    post_ids_processed.add(post.id)
+    post_ids_processed.add(post_id)
 
     # Never try to reply if a post is locked
     if post.locked:
         skip_reason = "post_locked"
     # Never reply to a deleted post
-    elif not post.author:
+    elif not author:
         skip_reason = "no_author"
     # Make sure we're not replying to ourself
-    elif "warrenplanbot" in post.author.name.lower():
+    elif author.name.lower().startswith(BOT_USERNAME_PREFIX):
         skip_reason = "own_post"
     # Ensure it's a post where someone summoned us
-    elif not re.search("!warrenplanbot", post.text, re.IGNORECASE):
+    elif TRIGGER_WORD not in full_post_text.lower():
         skip_reason = "trigger_not_found"
     else:
         skip_reason = None
 
+    # already looked up, so create_db_record doesn't have to look them up again
+    post_fields = {
+        "post_id": post_id,
+        "post_type": post_type,
+        "post_text": full_post_text,
+        "author": author,
+    }
+
     if skip_reason:
         post_record = create_db_record(
-            post, processed=True, skipped=True, skip_reason=skip_reason
+            post,
+            processed=True,
+            skipped=True,
+            skip_reason=skip_reason,
+            **post_fields,
         )
         if not skip_tracking:
-            posts_db.document(post.id).set(post_record)
+            # we never reply to skipped posts, so there's no risk of double-posting
+            # if their record is written later along with others
+            if skipped_post_writes is not None:
+                skipped_post_writes.append((posts_db.document(post_id), post_record))
+            else:
+                _write_in_background(posts_db.document(post_id).set, post_record)
         return
 
-    post_text, options = process_flags(get_trigger_line(post.text))
+    post_text, options = process_flags(get_trigger_line(full_post_text))
 
     match_info = (
         RuleStrategy.match_verbatim(verbatims, post_text, options)
@@ -291,37 +398,41 @@ def process_post(
     # Create partial db entry from known values, placeholder defaults for mutable values
     # Mark post as processed _before_ we reply to prevent double-posting
     post_record = create_db_record(
-        post, match, plan_confidence, plan_id, verbatim_id, processed=True
+        post,
+        match,
+        plan_confidence,
+        plan_id,
+        verbatim_id,
+        processed=True,
+        **post_fields,
     )
 
     if not skip_tracking:
-        posts_db.document(post.id).set(post_record)
-
-    operations_map = {
-        "verbatim": partial(build_verbatim_response_text, verbatim),
-        "all_the_plans": partial(build_all_plans_response_text, plans),
-        "state_of_race": partial(
-            build_state_of_race_response_text, datetime.date.today()
-        ),
-    }
+        record_written = _write_in_background(
+            posts_db.document(post_id).set, post_record
+        )
 
     post_record_update = {}
 
     # If plan is matched with confidence, build and send reply
     if match:
-        logger.info(f"plan match: {plan_id} {post.id} {plan_confidence}")
+        logger.info(f"plan match: {plan_id} {post_id} {plan_confidence}")
 
-        reply_string, reply_type = build_plan_response_text(plan, post.text)
+        reply_string, reply_type = build_plan_response_text(plan, full_post_text)
         post_record_update["reply_type"] = reply_type
-    elif operation and operation in operations_map:
-        logger.info(f"{operation} requested: {post.id}")
+    elif operation in OPERATIONS:
+        logger.info(f"{operation} requested: {post_id}")
 
-        response_fn = operations_map[operation]
-        reply_string = response_fn()
+        if operation == "verbatim":
+            reply_string = build_verbatim_response_text(verbatim)
+        elif operation == "all_the_plans":
+            reply_string = build_all_plans_response_text(plans)
+        else:
+            reply_string = build_state_of_race_response_text(datetime.date.today())
         post_record_update["reply_type"] = "operation"
         post_record_update["operation"] = operation
     else:
-        logger.info(f"topic mismatch: {plan_id} {post.id} {plan_confidence}")
+        logger.info(f"topic mismatch: {plan_id} {post_id} {plan_confidence}")
 
         reply_string = build_no_match_response_text(potential_matches, post)
         post_record_update["reply_type"] = "no_match"
@@ -330,6 +441,11 @@ def process_post(
     if "parent" in options:
         reply_string = parent_reply_prefix(post) + reply_string
 
+    if not skip_tracking:
+        # the reply text is built while the record is written, but the record
+        # must be in place before we reply
+        record_written.result()
+
     try:
         did_reply = reply(
             post, reply_string, parent="parent" in options, send=send, simulate=simulate
@@ -348,7 +464,43 @@ def process_post(
         post_record_update["reply_timestamp"] = firestore.SERVER_TIMESTAMP
 
     if not skip_tracking:
-        posts_db.document(post.id).update(post_record_update)
+        _write_in_background(posts_db.document(post_id).update, post_record_update)
+
+
+def _id_from_fullname(fullname: str) -> str:
+    """
+    Remove the Reddit type prefix (t1_, t3_, t5_...) from a fullname, leaving only the ID itself.
+    IDs are base36, so they never contain an underscore themselves
+    """
+    return fullname.split("_", 1)[-1]
+
+
+# Every field of a post's db record, with its default. Records are copied from this,
+# so the dict is already sized for all its fields, and only fields with a value are set
+DB_RECORD_TEMPLATE = {
+    "processed": False,
+    "processed_timestamp": firestore.SERVER_TIMESTAMP,
+    "replied": False,
+    "skipped": False,
+    "skip_reason": None,
+    "type": None,
+    "post_id": None,
+    "post_author": None,
+    "post_text": None,
+    "post_parent_id": None,  # ID or None if no parent_id
+    "post_url": None,
+    "post_subreddit_id": None,
+    "post_subreddit_display_name": None,
+    "post_title": None,  # Post Title or None if no title
+    "post_top_level_parent_id": None,
+    "post_locked": None,
+    # TODO flesh out / clarify this some
+    "plan_match": None,
+    "top_plan_confidence": None,
+    "top_plan": None,
+    "verbatim_id": None,
+    "reply_timestamp": None,
+}
 
 
 def create_db_record(
@@ -362,53 +514,82 @@ def create_db_record(
     processed=False,
     skipped=False,
     skip_reason=None,
+    post_id=None,
+    post_type=None,
+    post_text=None,
+    author=None,
 ) -> dict:
-    # Reddit 3-digit code prefix removed for each id, leaving only the ID itself
-    post_parent_id = post.parent_id[3:] if post.type == "comment" else None
-    post_subreddit_id = post.subreddit.name[3:]
-    post_top_level_parent_id = post.link_id[3:] if post.type == "comment" else None
-    post_title = post.title if post.type == "submission" else None
+    """
+    post_id, post_type, post_text and author can be given if they've already been
+    looked up from the post, otherwise they're looked up here
+    """
+    if post_id is None:
+        post_id = post.id
+    if post_type is None:
+        post_type = post.type
+    if post_text is None:
+        post_text = post.text
+    if author is None:
+        author = post.author
+    subreddit = post.subreddit
+
     # Return db_entry for Firestore
-    entry = {
-        "processed": processed,
-        "processed_timestamp": firestore.SERVER_TIMESTAMP,
-        "replied": reply_made,
-        "skipped": skipped,
-        "skip_reason": skip_reason,
-        "type": post.type,
-        "post_id": post.id,
-        "post_author": "/u/" + post.author.name,
-        "post_text": post.text,
-        "post_parent_id": post_parent_id,  # ID or None if no parent_id
-        "post_url": "https://www.reddit.com" + post.permalink,
-        "post_subreddit_id": post_subreddit_id,
-        "post_subreddit_display_name": post.subreddit.display_name,
-        "post_title": post_title,  # Post Title or None if no title
-        "post_top_level_parent_id": post_top_level_parent_id,
-        "post_locked": post.locked,
-        # TODO flesh out / clarify this some
-        "plan_match": match,
-        "top_plan_confidence": plan_confidence,
-        "top_plan": plan_id,
-        "verbatim_id": verbatim_id,
-        "reply_timestamp": reply_timestamp,
-    }
+    entry = DB_RECORD_TEMPLATE.copy()
+    entry["processed"] = processed
+    entry["replied"] = reply_made
+    entry["skipped"] = skipped
+    entry["skip_reason"] = skip_reason
+    entry["type"] = post_type
+    entry["post_id"] = post_id
+    entry["post_author"] = "/u/" + author.name
+    entry["post_text"] = post_text
+    entry["post_url"] = "https://www.reddit.com" + post.permalink
+    entry["post_subreddit_id"] = _id_from_fullname(subreddit.name)
+    entry["post_subreddit_display_name"] = subreddit.display_name
+    if post_type == "comment":
+        entry["post_parent_id"] = _id_from_fullname(post.parent_id)
+        entry["post_top_level_parent_id"] = _id_from_fullname(post.link_id)
+    else:
+        entry["post_title"] = post.title
+    entry["post_locked"] = post.locked
+    entry["plan_match"] = match
+    entry["top_plan_confidence"] = plan_confidence
+    entry["top_plan"] = plan_id
+    entry["verbatim_id"] = verbatim_id
+    entry["reply_timestamp"] = reply_timestamp
 
     return entry
 
 
-def get_trigger_line(text: str, trigger_word="!warrenplanbot") -> str:
+@lru_cache(maxsize=8)
+def _trigger_line_re(trigger_word: str) -> re.Pattern:
+    return re.compile(
+        rf"{trigger_word}[^-\w]+([^!?.]*[!?.]?)", re.IGNORECASE | re.MULTILINE
+    )
+
+
+def get_trigger_line(text: str, trigger_word=TRIGGER_WORD) -> str:
     """
     Get the final sentance that !WarrenPlanBot occurs in,
     only returning the part of that sentance which occurs _after_ !WarrenPlanBot
     """
-    matches = re.findall(
-        rf"{trigger_word}[^-\w]+([^!?.]*[!?.]?)", text, re.IGNORECASE | re.MULTILINE
-    )
-    if not matches:
+    # only the last match is needed, so walk the matches rather than building a list of them
+    last_match = None
+    for last_match in _trigger_line_re(trigger_word).finditer(text):
+        pass
+
+    if not last_match:
         return ""
 
-    return matches[-1]
+    return last_match.group(1)
+
+
+def _is_flag_like(token: str) -> bool:
+    return (
+        token.startswith("-")
+        and token not in ("-", "--")
+        and not NEGATIVE_NUMBER_RE.match(token)
+    )
 
 
 def process_flags(text):
@@ -416,17 +597,16 @@ def process_flags(text):
     Identifies flags in the text. Removes the flags from the text and
     returns the tuple (remaining_text, options).
     """
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument("--parent", "--tell-parent", action="store_true")
-    parser.add_argument("--why-warren", action="store_true")
-    parser.add_argument(
-        "--state-of-race", "--state-of-the-race", "--status-check", action="store_true"
-    )
-    parser.add_argument("rest", nargs=argparse.REMAINDER)
-    options, unknown = parser.parse_known_args(text.split())
-    remaining_text = " ".join(options.rest)
-    del options.rest  # we don't need this, and removing it makes testing easier
-    return (
-        remaining_text,
-        {flag for flag, is_true in vars(options).items() if is_true},
-    )
+    tokens = text.split()
+    options = set()
+
+    # flags come first. anything that looks like a flag but isn't one is dropped,
+    # while a bare "-" or "--", or a negative number, is kept as text (as argparse did)
+    text_start = 0
+    while text_start < len(tokens) and _is_flag_like(tokens[text_start]):
+        flag = FLAGS.get(tokens[text_start])
+        if flag:
+            options.add(flag)
+        text_start += 1
+
+    return " ".join(tokens[text_start:]), options
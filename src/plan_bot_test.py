@@ -1,9 +1,11 @@
 import datetime
+import time
 from unittest import mock
 
 import pytest
 
 import plan_bot
+from plans import Plans
 
 
 class MockSubreddit:
@@ -238,7 +240,7 @@ def test_build_response_text_to_all_the_plans_operation(
     mock_submission, mock_plan, mock_plan_cluster
 ):
     response_text = plan_bot.build_all_plans_response_text(
-        [mock_plan] * 5 + [mock_plan_cluster] * 3
+        Plans([mock_plan] * 5 + [mock_plan_cluster] * 3)
     )
 
     assert type(response_text) is str
@@ -252,6 +254,22 @@ def test_build_response_text_to_all_the_plans_operation(
         assert plan["url"] not in response_text
 
 
+def test_build_all_plans_response_text_is_shared_by_equal_plans_lists(mock_plan):
+    plan_bot._build_all_plans_response_text.cache_clear()
+
+    # each pass loads its own, equal, list of plans
+    response = plan_bot.build_all_plans_response_text(Plans([dict(mock_plan)] * 3))
+    assert (
+        plan_bot.build_all_plans_response_text(Plans([dict(mock_plan)] * 3)) == response
+    )
+    assert plan_bot._build_all_plans_response_text.cache_info().misses == 1
+
+    # a change to what the table shows builds a fresh response
+    changed_plan = dict(mock_plan, display_title="Another Plan Title")
+    assert plan_bot.build_all_plans_response_text(Plans([changed_plan] * 3)) != response
+    assert plan_bot._build_all_plans_response_text.cache_info().misses == 2
+
+
 def test_build_response_text_to_state_of_race_operation(
     mock_submission, mock_plan, mock_plan_cluster
 ):
@@ -430,6 +448,27 @@ def test_process_post_wont_reply_to_locked_post(
     mock_reply.assert_not_called()
 
 
+@mock.patch("plan_bot.create_db_record", return_value={"skipped": True})
+@mock.patch("plan_bot.reply")
+def test_process_post_adds_skipped_post_to_writes(mock_reply, mock_create_db_record):
+    post = MockSubmission("!WarrenPlanBot A Title for the 21st Century")
+    post.locked = True
+    posts_db = mock.MagicMock()
+    skipped_post_writes = []
+
+    plan_bot.process_post(
+        post,
+        PLANS,
+        VERBATIMS,
+        posts_db=posts_db,
+        skipped_post_writes=skipped_post_writes,
+    )
+
+    assert skipped_post_writes == [(posts_db.document(post.id), {"skipped": True})]
+    posts_db.document(post.id).set.assert_not_called()
+    mock_reply.assert_not_called()
+
+
 @mock.patch("plan_bot.create_db_record")
 @mock.patch(
     "plan_bot.build_plan_response_text",
@@ -461,6 +500,33 @@ def test_process_post_matches_real_plan(
     )
 
 
+@mock.patch("plan_bot.create_db_record")
+@mock.patch(
+    "plan_bot.build_plan_response_text", return_value=("response text", "reply_type")
+)
+@mock.patch("plan_bot.reply")
+def test_process_post_writes_record_before_replying(
+    mock_reply, mock_build_response_text, mock_create_db_record
+):
+    events = []
+
+    def slow_set(record):
+        # give the reply a chance to go out first if it isn't waiting on the record
+        time.sleep(0.1)
+        events.append("set")
+
+    posts_db = mock.MagicMock()
+    posts_db.document.return_value.set.side_effect = slow_set
+    mock_reply.side_effect = lambda *args, **kwargs: events.append("reply")
+
+    post = MockSubmission("!WarrenPlanBot A Title for the 21st Century")
+
+    plan_bot.process_post(post, PLANS, VERBATIMS, posts_db=posts_db)
+    plan_bot.wait_for_db_writes()
+
+    assert events == ["set", "reply"]
+
+
 @mock.patch("plan_bot.create_db_record")
 @mock.patch(
     "plan_bot.build_plan_response_text", return_value=("response text", "reply_type")
@@ -554,7 +620,68 @@ def test_get_trigger_line():
         ("--why-warren --parent what's up", "what's up", {"parent", "why_warren"}),
         ("--state-of-race what's up", "what's up", {"state_of_race"}),
         ("--state-of-the-race what's up", "what's up", {"state_of_race"}),
+        ("--status-check what's up", "what's up", {"state_of_race"}),
+        ("--state what's up", "what's up", set()),
+        ("what's up --parent", "what's up --parent", set()),
+        ("--parent", "", {"parent"}),
+        ("- medicare for all", "- medicare for all", set()),
+        ("-5 percent tax", "-5 percent tax", set()),
+        ("-.5 percent tax", "-.5 percent tax", set()),
+        ("-- foo", "-- foo", set()),
+        ("--parent -5 percent tax", "-5 percent tax", {"parent"}),
+        ("", "", set()),
     ],
 )
 def test_process_flags(input, expected_rest, expected_flags):
     assert plan_bot.process_flags(input) == (expected_rest, expected_flags)
+
+
+def test_wait_for_db_writes_raises_background_errors():
+    posts_db = mock.MagicMock()
+    posts_db.document.return_value.update.side_effect = RuntimeError("write failed")
+
+    plan_bot._write_in_background(posts_db.document("abc").update, {})
+
+    with pytest.raises(RuntimeError):
+        plan_bot.wait_for_db_writes()
+
+    # failed writes aren't raised again on the next wait
+    plan_bot.wait_for_db_writes()
+
+
+def test_create_db_record_strips_fullname_prefixes(mock_comment):
+    mock_comment.author = MockAuthor()
+    mock_comment.locked = False
+    mock_comment.parent_id = "t1_abc12"
+    mock_comment.link_id = "t3_def34"
+    mock_comment.subreddit.name = "t5_2qh1i"
+    mock_comment.subreddit.display_name = "WPBSandbox"
+
+    record = plan_bot.create_db_record(mock_comment)
+
+    assert record["post_parent_id"] == "abc12"
+    assert record["post_top_level_parent_id"] == "def34"
+    assert record["post_subreddit_id"] == "2qh1i"
+    assert record["post_title"] is None
+
+
+def test_create_db_record_uses_given_post_fields(mock_comment):
+    mock_comment.locked = False
+    mock_comment.parent_id = "t1_abc12"
+    mock_comment.link_id = "t3_def34"
+    mock_comment.subreddit.name = "t5_2qh1i"
+    mock_comment.subreddit.display_name = "WPBSandbox"
+    # the post's own fields aren't looked up when they're given
+    del mock_comment.text
+
+    record = plan_bot.create_db_record(
+        mock_comment,
+        post_id="456",
+        post_type="comment",
+        post_text="text of comment",
+        author=MockAuthor(),
+    )
+
+    assert record["post_id"] == "456"
+    assert record["post_text"] == "text of comment"
+    assert record["post_author"] == "/u/aredditusername"
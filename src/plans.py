@@ -2,6 +2,8 @@ import json
 from os import path
 from typing import Literal, NotRequired, TypedDict, Union
 
+import orjson
+
 DIRNAME = path.dirname(path.realpath(__file__))
 PLANS_FILE = path.abspath(path.join(DIRNAME, "plans.json"))
 PLANS_CLUSTERS_FILE = path.abspath(path.join(DIRNAME, "plan_clusters.json"))
@@ -44,7 +46,18 @@ Plan = Union[
 ]  # many functions will take either a pure plan or a plan cluster, as either can be matched
 
 
-def load_plans() -> list[Plan]:
+class Plans(list[Plan]):
+    """
+    A list of plans, along with the pure plans among them.
+    Whether a plan is a cluster never changes, so the pure plans are picked out once
+    """
+
+    def __init__(self, plans):
+        super().__init__(plans)
+        self.pure: list[PurePlan] = [plan for plan in self if not plan["is_cluster"]]
+
+
+def load_plans() -> Plans:
     """
         Load all plans from json files
     }
@@ -54,18 +67,16 @@ def load_plans() -> list[Plan]:
 
     for plan in pure_plans:
         plan["is_cluster"] = False
-        plan["full_text"] = json.load(
-            open(path.join(PLAN_TEXT_DIR, plan["id"] + ".json"))
-        )["text"]
+        with open(path.join(PLAN_TEXT_DIR, plan["id"] + ".json"), "rb") as text_file:
+            plan["full_text"] = orjson.loads(text_file.read())["text"]
 
     with open(PLANS_CLUSTERS_FILE) as json_file:
         plan_clusters = json.load(json_file)
 
+    pure_plans_by_id = {plan["id"]: plan for plan in pure_plans}
+
     for plan in plan_clusters:
         plan["is_cluster"] = True
-        plan["plans"] = [
-            next(filter(lambda p: p["id"] == plan_id, pure_plans))
-            for plan_id in plan["plan_ids"]
-        ]
+        plan["plans"] = [pure_plans_by_id[plan_id] for plan_id in plan["plan_ids"]]
 
-    return pure_plans + plan_clusters
+    return Plans(pure_plans + plan_clusters)